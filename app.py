@@ -1,24 +1,51 @@
+import hashlib
+import json
+import logging
 import os
 import re
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property, lru_cache
 from datetime import datetime, timezone
 from decimal import Decimal, ROUND_HALF_UP
 from urllib.parse import quote
 
+import click
+import redis
 import requests
 import stripe
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    from PIL import Image, ImageOps, UnidentifiedImageError
+except ImportError:  # sem Pillow: serve só o original
+    Image = None
 
 from flask import (
     Flask, render_template, request, redirect, url_for, flash,
-    session, abort, send_from_directory, jsonify
+    session, abort, send_from_directory, jsonify, g, current_app
 )
+from flask_caching import Cache
+from flask_compress import Compress
+from flask_session import Session
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import delete, event, func, inspect, select, text, update
+from sqlalchemy.exc import DBAPIError, IntegrityError, SQLAlchemyError
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.schema import CreateIndex
+from sqlalchemy.orm import load_only, raiseload, selectinload, undefer, validates
 from flask_login import (
     LoginManager, login_user, logout_user,
     login_required, current_user, UserMixin
 )
 from flask_wtf import FlaskForm
-from slugify import slugify
-from werkzeug.security import generate_password_hash, check_password_hash
+from jinja2 import FileSystemBytecodeCache
+from slugify import slugify as _slugify
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
 from werkzeug.utils import secure_filename
 from wtforms import (
     StringField, PasswordField, BooleanField, TextAreaField,
@@ -29,16 +56,34 @@ from wtforms.validators import DataRequired, Length, NumberRange, Optional
 from config import Config
 
 db = SQLAlchemy()
+cache = Cache()
+compress = Compress()
 login_manager = LoginManager()
 login_manager.login_view = "login"
+log = logging.getLogger(__name__)
 
 
 # -------------------------
 # Helpers
 # -------------------------
+_NON_DIGITS = re.compile(r"\D+")
+ALLOWED_EXTENSIONS = frozenset(("png", "jpg", "jpeg", "webp"))
+ALLOWED_ORDER_STATUSES = frozenset(("Novo", "Pagando", "Pago", "Separando", "Enviado", "Concluído", "Cancelado"))
+# só pedidos ainda não pagos podem virar "Pago" (não regride Separando/Enviado/Cancelado)
+PAYABLE_STATUSES = frozenset(("Novo", "Pagando"))
+# eventos do Stripe Checkout tratados pelo webhook
+STRIPE_SESSION_EVENTS = frozenset((
+    "checkout.session.completed",
+    "checkout.session.async_payment_succeeded",
+    "checkout.session.async_payment_failed",
+))
+
 def now_utc():
     return datetime.now(timezone.utc)
 
+def to_cents(v) -> int:
+    return int(money(v) * 100)
+
 def money(v) -> Decimal:
     if v is None:
         return Decimal("0.00")
@@ -46,23 +91,204 @@ def money(v) -> Decimal:
         return v.quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
     return Decimal(str(v)).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
 
-def format_brl(v: Decimal) -> str:
-    v = money(v)
-    s = f"{v:.2f}"
+def _thousands(digits: str) -> str:
+    # "1234567" -> "1.234.567" (grupos de 3 a partir da direita)
+    parts = []
+    i = len(digits)
+    while i > 3:
+        parts.append(digits[i - 3:i])
+        i -= 3
+    parts.append(digits[:i])
+    return ".".join(reversed(parts))
+
+@lru_cache(maxsize=4096)
+def _format_brl_str(s: str) -> str:
+    # s já quantizado ("1234.50"); valores se repetem muito no carrinho
     inteiro, dec = s.split(".")
-    inteiro = re.sub(r"(?<!^)(?=(\d{3})+$)", ".", inteiro)
-    return f"R$ {inteiro},{dec}"
+    sign = ""
+    if inteiro.startswith("-"):
+        sign, inteiro = "-", inteiro[1:]
+    return f"R$ {sign}{_thousands(inteiro)},{dec}"
+
+def format_brl(v: Decimal) -> str:
+    return _format_brl_str(f"{money(v):.2f}")
+
+@lru_cache(maxsize=1024)
+def slugify(text: str) -> str:
+    # nomes de produto/categoria se repetem (seed, checagem de slug)
+    return _slugify(text)
 
 def allowed_file(filename: str) -> bool:
     ext = filename.lower().rsplit(".", 1)[-1] if "." in filename else ""
-    return ext in {"png", "jpg", "jpeg", "webp"}
+    return ext in ALLOWED_EXTENSIONS
 
-def secure_upload_name(prefix: str, filename: str) -> str:
+def secure_upload_name(prefix: str, filename: str, digest: str = "") -> str:
     safe = secure_filename(filename)
+    if digest:
+        return f"{prefix}-{digest}-{safe}"
     return f"{prefix}-{safe}"
 
+UPLOAD_CHUNK = 1024 * 1024
+
+def save_upload(file, prefix: str) -> str:
+    # hash do conteúdo no nome: cada versão da imagem tem URL própria (cache immutable seguro)
+    # uma passada só: copia em blocos para um temporário na mesma pasta enquanto calcula o hash,
+    # depois os.replace atômico (arquivo parcial nunca fica visível)
+    folder = current_app.config["UPLOAD_FOLDER"]
+    h = hashlib.blake2b(digest_size=8)  # mais rápido que sha1/md5 e sem problema em hosts FIPS
+    tmp = tempfile.NamedTemporaryFile(dir=folder, prefix=".upload-", delete=False)
+    try:
+        with tmp:
+            for chunk in iter(lambda: file.stream.read(UPLOAD_CHUNK), b""):
+                h.update(chunk)
+                tmp.write(chunk)
+        os.chmod(tmp.name, 0o644)  # NamedTemporaryFile cria 0600
+        filename = secure_upload_name(prefix, file.filename, h.hexdigest())
+        os.replace(tmp.name, os.path.join(folder, filename))
+    except BaseException:
+        if os.path.exists(tmp.name):
+            os.unlink(tmp.name)
+        raise
+    # versões reduzidas em segundo plano; o request não espera o resize
+    executor = current_app.extensions.get("upload_executor")
+    if executor is not None:
+        executor.submit(make_derivatives, folder, filename)
+    return filename
+
+# Larguras geradas em WebP para cada upload (card e hero) e qualidade de cada uma
+IMAGE_WIDTHS = {400: 80, 1600: 82}
+
+def derivative_name(filename: str, width: int) -> str:
+    return f"{os.path.splitext(filename)[0]}_{width}.webp"
+
+def make_derivatives(folder: str, filename: str) -> None:
+    tmp = None
+    try:
+        with Image.open(os.path.join(folder, filename)) as im:
+            im.draft("RGB", (max(IMAGE_WIDTHS), max(IMAGE_WIDTHS)))  # JPEG: decodifica já reduzido
+            im = ImageOps.exif_transpose(im)  # foto de celular: aplica a orientação do EXIF
+            im = im.convert("RGBA" if im.mode in ("RGBA", "LA", "P") else "RGB")
+            for width, quality in IMAGE_WIDTHS.items():
+                out = im.copy()
+                out.thumbnail((width, width * 4))
+                target = os.path.join(folder, derivative_name(filename, width))
+                tmp = target + ".tmp"
+                out.save(tmp, "WEBP", quality=quality, method=4)
+                os.replace(tmp, target)
+                tmp = None
+        _mark_derivatives_ready(filename)  # neste processo anuncia já, sem esperar o TTL do negativo
+    except UnidentifiedImageError:
+        log.warning("upload %s não é uma imagem válida; servindo só o original", filename)
+    except Exception:
+        # disco cheio, permissão etc.: fica só o original, mas registra
+        log.exception("falha ao gerar versões reduzidas de %s", filename)
+    finally:
+        if tmp and os.path.exists(tmp):
+            os.unlink(tmp)
+
+# Quais uploads já têm as versões reduzidas. Nomes levam hash do conteúdo, então
+# o positivo não muda; o negativo expira (o resize roda em segundo plano).
+# Os dois são limitados: ao encher, são zerados.
+DERIVATIVE_CACHE_MAX = 4096
+DERIVATIVE_MISS_TTL = 60
+_derivs_ready: set = set()
+_derivs_missing: dict = {}
+
+def _mark_derivatives_ready(filename: str) -> None:
+    if len(_derivs_ready) >= DERIVATIVE_CACHE_MAX:
+        _derivs_ready.clear()
+    _derivs_ready.add(filename)
+    _derivs_missing.pop(filename, None)
+
+def derivatives_ready(filename: str) -> bool:
+    if not filename:
+        return False
+    if filename in _derivs_ready:
+        return True
+    now = time.monotonic()
+    checked = _derivs_missing.get(filename)
+    if checked is not None and now - checked < DERIVATIVE_MISS_TTL:
+        return False
+    folder = current_app.config["UPLOAD_FOLDER"]
+    if all(os.path.exists(os.path.join(folder, derivative_name(filename, w))) for w in IMAGE_WIDTHS):
+        _mark_derivatives_ready(filename)
+        return True
+    if len(_derivs_missing) >= DERIVATIVE_CACHE_MAX:
+        _derivs_missing.clear()
+    _derivs_missing[filename] = now
+    return False
+
+def upload_srcset(filename: str) -> str:
+    # só anuncia as versões que já existem em disco
+    if not derivatives_ready(filename):
+        return ""
+    prefix = url_for("uploads", filename="")
+    return ", ".join(f"{prefix}{derivative_name(filename, w)} {w}w" for w in IMAGE_WIDTHS)
+
+def upload_variant(filename: str, width: int) -> str:
+    # versão reduzida se já existir, senão o original
+    if derivatives_ready(filename):
+        return derivative_name(filename, width)
+    return filename
+
+def backfill_derivatives() -> tuple[int, int]:
+    # uploads antigos (anteriores ao resize): gera as versões que faltam
+    folder = current_app.config["UPLOAD_FOLDER"]
+    names = set()
+    for model in (Product, Banner):
+        names.update(n for (n,) in db.session.execute(
+            select(model.image_filename).where(model.image_filename != "")
+        ))
+    done = 0
+    for name in sorted(names):
+        if not os.path.exists(os.path.join(folder, name)):
+            continue
+        if all(os.path.exists(os.path.join(folder, derivative_name(name, w))) for w in IMAGE_WIDTHS):
+            continue
+        make_derivatives(folder, name)
+        done += 1
+    return done, len(names)
+
+def remove_upload(filename: str) -> None:
+    # original + versões reduzidas (as que já existirem)
+    folder = current_app.config["UPLOAD_FOLDER"]
+    _derivs_ready.discard(filename)
+    for name in [filename] + [derivative_name(filename, w) for w in IMAGE_WIDTHS]:
+        try:
+            os.unlink(os.path.join(folder, name))
+        except FileNotFoundError:
+            pass
+
+# Sessão HTTP reaproveitada entre pedidos (mantém conexões TLS abertas com o Mercado Pago)
+MP_SESSION = requests.Session()
+MP_SESSION.headers.update({"Content-Type": "application/json"})
+MP_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=20,
+    pool_maxsize=50,
+    max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=[502, 503, 504]),
+))
+
+@lru_cache(maxsize=64)
+def _static_mtime(folder: str, filename: str) -> int:
+    try:
+        return int(os.stat(os.path.join(folder, filename)).st_mtime)
+    except OSError:
+        return 0
+
+# Chave de idempotência do Checkout: mesmo pedido + mesmos parâmetros (itens, URLs,
+# email) + mesma janela de tempo. Clique duplo reaproveita a sessão; pedido alterado,
+# host diferente ou nova tentativa depois de um erro (o Stripe repete a resposta
+# salva, inclusive 500, por 24h) geram outra chave.
+STRIPE_IDEMPOTENCY_WINDOW = 600  # segundos
+
+def stripe_idempotency_key(order_id: int, params: dict) -> str:
+    digest = hashlib.blake2b(
+        json.dumps(params, sort_keys=True, default=str).encode(), digest_size=8
+    ).hexdigest()
+    return f"order-{order_id}-{digest}-{int(time.time() // STRIPE_IDEMPOTENCY_WINDOW)}"
+
 def wa_link(phone: str, message: str) -> str:
-    phone = re.sub(r"\D+", "", phone or "")
+    phone = _NON_DIGITS.sub("", phone or "")
     return f"https://wa.me/{phone}?text={quote(message)}"
 
 
@@ -76,6 +302,7 @@ def cart_get():
 def cart_save(cart: dict):
     session["cart"] = cart
     session.modified = True
+    g.pop("_cart_payload", None)
 
 def cart_key(product_id: int, size: str | None):
     s = (size or "").strip().upper()
@@ -91,14 +318,27 @@ def cart_count(cart: dict) -> int:
     return sum(int(q) for q in cart.values())
 
 def cart_products_map(cart: dict):
+    # memoizado por request (context processor, cart_payload e checkout usam o mesmo mapa)
     if not cart:
         return {}
-    pids = []
+    pids = set()
     for k in cart.keys():
         pid, _ = cart_split_key(k)
-        pids.append(pid)
-    products = Product.query.filter(Product.id.in_(pids), Product.is_active.is_(True)).all()
-    return {p.id: p for p in products}
+        pids.add(pid)
+    key = tuple(sorted(pids))
+
+    cache = g.setdefault("_pmap", {})
+    if key in cache:
+        return cache[key]
+
+    # só as colunas que o carrinho usa (linhas somente leitura, sem hidratar o ORM)
+    rows = db.session.query(
+        Product.id, Product.name, Product.slug, Product.price,
+        Product.stock, Product.image_filename, Product.is_active,
+    ).filter(Product.id.in_(key), Product.is_active.is_(True)).all()
+    pmap = {p.id: p for p in rows}
+    cache[key] = pmap
+    return pmap
 
 def cart_subtotal(cart: dict) -> Decimal:
     if not cart:
@@ -113,11 +353,80 @@ def cart_subtotal(cart: dict) -> Decimal:
         total += money(p.price) * int(qty)
     return money(total)
 
+SETTINGS_REDIS_KEY = "settings"
+
+def _settings_from_db() -> dict:
+    return {s.key: s.value for s in Setting.query.all()}
+
+def _settings_from_redis(r) -> dict:
+    # hash "settings" no Redis; no miss, popula a partir do banco
+    try:
+        m = r.hgetall(SETTINGS_REDIS_KEY)
+        if m:
+            return m
+        m = _settings_from_db()
+        if m:
+            pipe = r.pipeline()
+            pipe.hset(SETTINGS_REDIS_KEY, mapping={k: ("" if v is None else v) for k, v in m.items()})
+            pipe.expire(SETTINGS_REDIS_KEY, current_app.config.get("SETTINGS_CACHE_TTL", 3600))
+            pipe.execute()
+        return m
+    except redis.RedisError:
+        return _settings_from_db()
+
+class SettingsCache:
+    # cópia das configurações no processo; recarrega após `ttl` segundos ou clear()
+    # (o ttl limita quanto tempo outros workers ficam com valores antigos)
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = None
+        self._loaded_at = 0.0
+
+    def _fresh(self, ttl: float) -> bool:
+        return self._data is not None and time.monotonic() - self._loaded_at < ttl
+
+    def get(self, loader, ttl: float) -> dict:
+        if self._fresh(ttl):
+            return self._data
+        with self._lock:
+            if not self._fresh(ttl):
+                self._data = loader()
+                self._loaded_at = time.monotonic()
+            return self._data
+
+    def clear(self):
+        with self._lock:
+            self._data = None
+
+settings_cache = SettingsCache()
+
+def _load_settings() -> dict:
+    r = current_app.extensions.get("redis")
+    return _settings_from_redis(r) if r is not None else _settings_from_db()
+
+def _settings_map() -> dict:
+    # snapshot fixo durante o request; fora dele só um dict em memória do processo
+    m = g.get("_settings")
+    if m is None:
+        m = settings_cache.get(_load_settings, current_app.config.get("SETTINGS_LOCAL_TTL", 60))
+        g._settings = m
+    return m
+
+def settings_cache_clear():
+    g.pop("_settings", None)
+    settings_cache.clear()
+    r = current_app.extensions.get("redis")
+    if r is not None:
+        try:
+            r.delete(SETTINGS_REDIS_KEY)
+        except redis.RedisError:
+            pass
+
 def get_setting(key: str, default: str = "") -> str:
-    s = Setting.query.filter_by(key=key).first()
-    if not s or s.value is None:
+    v = _settings_map().get(key)
+    if v is None:
         return default
-    return str(s.value)
+    return str(v)
 
 def get_setting_decimal(key: str, default: str) -> Decimal:
     try:
@@ -137,6 +446,8 @@ def cart_payload(app: Flask):
     cart = cart_get()
     pmap = cart_products_map(cart)
     items = []
+    # nomes de upload já passam por secure_filename; basta concatenar ao prefixo
+    uploads_prefix = url_for("uploads", filename="")
 
     for k, qty in cart.items():
         pid, size = cart_split_key(k)
@@ -154,7 +465,7 @@ def cart_payload(app: Flask):
             "qty": int(qty),
             "unit_price_brl": format_brl(unit),
             "line_total_brl": format_brl(line),
-            "image_url": (url_for("uploads", filename=p.image_filename) if p.image_filename else ""),
+            "image_url": (uploads_prefix + p.image_filename if p.image_filename else ""),
             "stock": p.stock,
         })
 
@@ -173,6 +484,82 @@ def cart_payload(app: Flask):
         "currency": "BRL",
     }
 
+def _cart_ctx():
+    # payload do carrinho calculado uma vez por request (templates + API); cart_save invalida
+    p = g.get("_cart_payload")
+    if p is None:
+        p = cart_payload(current_app)
+        g._cart_payload = p
+    return p
+
+
+# -------------------------
+# Slugs
+# -------------------------
+def unique_slug(model, base: str) -> str:
+    # uma consulta traz todos os slugs "base%"; o sufixo livre é calculado em memória
+    existing = {s for (s,) in db.session.query(model.slug).filter(model.slug.like(f"{base}%"))}
+    if base not in existing:
+        return base
+    i = 2
+    while f"{base}-{i}" in existing:
+        i += 1
+    return f"{base}-{i}"
+
+def add_with_unique_slug(obj, base: str, attempts: int = 3) -> bool:
+    # o índice UNIQUE em slug é a garantia final: se outro request pegou o mesmo slug, recalcula
+    for _ in range(attempts):
+        obj.slug = unique_slug(type(obj), base)
+        db.session.add(obj)
+        try:
+            db.session.commit()
+            return True
+        except IntegrityError as e:
+            db.session.rollback()
+            # só conflito de slug justifica tentar de novo; outras constraints sobem
+            if "slug" not in str(e.orig).lower():
+                raise
+    return False
+
+
+# -------------------------
+# Admin caches (curtos; invalidados nas escritas)
+# -------------------------
+@cache.cached(timeout=60, key_prefix="admin_stats")
+def _compute_dashboard_stats() -> dict:
+    # cache miss: as quatro contagens num único round-trip
+    return scalar_counts(
+        produtos=select(func.count()).select_from(Product),
+        categorias=select(func.count()).select_from(Category),
+        pedidos=select(func.count()).select_from(Order),
+        novos=select(func.count()).select_from(Order).where(Order.status == "Novo"),
+    )
+
+def dashboard_stats_clear():
+    cache.delete("admin_stats")
+
+def _query_category_choices() -> list:
+    rows = db.session.execute(
+        select(Category.id, Category.name).where(Category.is_active.is_(True)).order_by(Category.name.asc())
+    ).all()
+    return [(0, "— Sem categoria —")] + [(cid, name) for cid, name in rows]
+
+@cache.memoize(timeout=300)
+def _cached_category_choices() -> list:
+    return _query_category_choices()
+
+def active_category_choices() -> list:
+    # choices do select de categoria no form de produto; categorias mudam pouco.
+    # Só usa o cache quando ele é compartilhado (Redis): com SimpleCache cada worker
+    # teria sua cópia e o clear valeria só para um, e o POST num worker desatualizado
+    # recusaria a categoria nova ("Not a valid choice").
+    if current_app.config.get("CACHE_TYPE") == "RedisCache":
+        return _cached_category_choices()
+    return _query_category_choices()
+
+def category_choices_clear():
+    cache.delete_memoized(_cached_category_choices)
+
 
 # -------------------------
 # Models
@@ -203,13 +590,16 @@ class Category(db.Model):
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=now_utc)
 
+    products = db.relationship("Product", back_populates="category")
+
 class Product(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    category_id = db.Column(db.Integer, db.ForeignKey("category.id"), nullable=True)
+    category_id = db.Column(db.Integer, db.ForeignKey("category.id", ondelete="SET NULL"), nullable=True)
 
     name = db.Column(db.String(180), nullable=False)
     slug = db.Column(db.String(220), unique=True, nullable=False, index=True)
-    description = db.Column(db.Text, default="")
+    # texto longo: só carregado quando acessado (página do produto / edição)
+    description = db.deferred(db.Column(db.Text, default=""))
 
     price = db.Column(db.Numeric(10, 2), nullable=False, default=0)
     stock = db.Column(db.Integer, nullable=False, default=0)
@@ -221,7 +611,25 @@ class Product(db.Model):
     image_filename = db.Column(db.String(255), default="")
     created_at = db.Column(db.DateTime, default=now_utc)
 
-    category = db.relationship("Category", lazy=True)
+    category = db.relationship("Category", back_populates="products")
+
+    @validates("sizes")
+    def _normalize_sizes(self, _key, value):
+        # grava já normalizado ("p, m ,g" -> "P,M,G")
+        self.__dict__.pop("size_list", None)
+        return ",".join(s.strip().upper() for s in (value or "").split(",") if s.strip())
+
+    @cached_property
+    def size_list(self) -> tuple:
+        # strip/upper ainda cobre linhas gravadas antes da normalização
+        return tuple(s.strip().upper() for s in (self.sizes or "").split(",") if s.strip())
+
+    # listagem /produtos: is_active (+ category_id) ordenado por created_at ou price
+    __table_args__ = (
+        db.Index("ix_product_active_created", is_active, created_at.desc()),
+        db.Index("ix_product_active_price", is_active, price),
+        db.Index("ix_product_cat_active_created", category_id, is_active, created_at.desc()),
+    )
 
 class Banner(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -248,13 +656,22 @@ class Order(db.Model):
     subtotal = db.Column(db.Numeric(10, 2), default=0)
     shipping = db.Column(db.Numeric(10, 2), default=0)
     total = db.Column(db.Numeric(10, 2), default=0)
+    shipping_cents = db.Column(db.Integer, nullable=False, default=0)  # Stripe/MP trabalham em centavos
 
     payment_provider = db.Column(db.String(40), default="")  # stripe, mercadopago, manual
     payment_ref = db.Column(db.String(240), default="")      # session_id, preference_id, etc
+    stripe_event_id = db.Column(db.String(255), default="")    # último evento de webhook aplicado
+    stripe_event_created = db.Column(db.Integer, default=0)
 
     created_at = db.Column(db.DateTime, default=now_utc)
 
-    items = db.relationship("OrderItem", backref="order", lazy=True, cascade="all, delete-orphan")
+    items = db.relationship("OrderItem", back_populates="order", cascade="all, delete-orphan")
+
+    # admin_pedidos: filtro por status + ordem por data (e só ordem quando sem filtro)
+    __table_args__ = (
+        db.Index("ix_order_status_created", status, created_at.desc()),
+        db.Index("ix_order_created", created_at.desc()),
+    )
 
 class OrderItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -265,9 +682,12 @@ class OrderItem(db.Model):
 
     size = db.Column(db.String(20), default="")
     unit_price = db.Column(db.Numeric(10, 2), nullable=False, default=0)
+    unit_price_cents = db.Column(db.Integer, nullable=False, default=0)
     quantity = db.Column(db.Integer, nullable=False, default=1)
     line_total = db.Column(db.Numeric(10, 2), nullable=False, default=0)
 
+    order = db.relationship("Order", back_populates="items")
+
 
 # -------------------------
 # Forms
@@ -347,21 +767,97 @@ DEFAULT_SETTINGS = {
     "accent_color": "#B08D57",
 }
 
+# campos de texto do form de configurações (salvos com strip); dinheiro é tratado à parte
+_STRIP_FIELDS = ("store_name", "store_tagline", "whatsapp", "topbar_note", "primary_color", "accent_color")
+_MONEY_FIELDS = ("shipping_free_over", "shipping_flat")
+
+# colunas adicionadas depois da criação das tabelas: (tabela, coluna, DDL, backfill)
+SCHEMA_PATCHES = (
+    ("order_item", "unit_price_cents", "INTEGER NOT NULL DEFAULT 0",
+     "UPDATE order_item SET unit_price_cents = CAST(ROUND(unit_price * 100) AS INTEGER)"),
+    ("order", "shipping_cents", "INTEGER NOT NULL DEFAULT 0",
+     'UPDATE "order" SET shipping_cents = CAST(ROUND(COALESCE(shipping, 0) * 100) AS INTEGER)'),
+    ("order", "stripe_event_id", "VARCHAR(255) DEFAULT ''", None),
+    ("order", "stripe_event_created", "INTEGER DEFAULT 0", None),
+)
+
+def _has_column(table: str, column: str) -> bool:
+    return column in {c["name"] for c in inspect(db.engine).get_columns(table)}
+
+def ensure_columns():
+    # create_all não altera tabelas existentes; adiciona as colunas novas e preenche
+    for table, column, ddl, backfill in SCHEMA_PATCHES:
+        if _has_column(table, column):
+            continue
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(text(f'ALTER TABLE "{table}" ADD COLUMN {column} {ddl}'))
+                if backfill:
+                    conn.execute(text(backfill))
+        except DBAPIError:
+            # outro processo adicionou a coluna (e fez o backfill) entre a checagem e o ALTER
+            if not _has_column(table, column):
+                raise
+
+def ensure_indexes():
+    # create_all não cria índices novos em tabelas que já existem;
+    # IF NOT EXISTS é atômico (checkfirst=True não é, com vários processos subindo juntos)
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            for idx in table.indexes:
+                conn.execute(CreateIndex(idx, if_not_exists=True))
+
+def init_db(app: Flask):
+    # schema + dados iniciais; idempotente
+    db.create_all()
+    ensure_columns()
+    ensure_indexes()
+    seed_if_needed(app)
+
+def upsert_insert(model):
+    # INSERT com suporte a ON CONFLICT (SQLite/Postgres); None nos outros bancos
+    dialect = db.session.get_bind().dialect.name
+    if dialect == "sqlite":
+        return sqlite_insert(model)
+    if dialect == "postgresql":
+        return pg_insert(model)
+    return None
+
 def ensure_settings():
-    for k, v in DEFAULT_SETTINGS.items():
-        if not Setting.query.filter_by(key=k).first():
-            db.session.add(Setting(key=k, value=str(v)))
+    rows = [{"key": k, "value": str(v)} for k, v in DEFAULT_SETTINGS.items()]
+    ins = upsert_insert(Setting)
+    if ins is not None:
+        db.session.execute(ins.values(rows).on_conflict_do_nothing(index_elements=["key"]))
+    else:
+        existing = {k for (k,) in db.session.query(Setting.key)}
+        new_rows = [row for row in rows if row["key"] not in existing]
+        if new_rows:
+            db.session.execute(Setting.__table__.insert(), new_rows)
     db.session.commit()
 
+def scalar_counts(**stmts) -> dict:
+    # várias contagens num único SELECT (uma subquery escalar por chave)
+    row = db.session.execute(
+        select(*(stmt.scalar_subquery().label(name) for name, stmt in stmts.items()))
+    ).one()
+    return dict(row._mapping)
+
 def seed_if_needed(app: Flask):
-    if User.query.count() == 0:
+    counts = scalar_counts(
+        users=select(func.count()).select_from(User),
+        categories=select(func.count()).select_from(Category),
+        products=select(func.count()).select_from(Product),
+        banners=select(func.count()).select_from(Banner),
+    )
+
+    if counts["users"] == 0:
         u = User(email="admin@local", is_admin=True)
         u.set_password("admin123")
         db.session.add(u)
 
     ensure_settings()
 
-    if Category.query.count() == 0:
+    if counts["categories"] == 0:
         cats = [
             ("Anéis", "ring"),
             ("Alianças", "rings"),
@@ -375,10 +871,11 @@ def seed_if_needed(app: Flask):
         for name, icon in cats:
             db.session.add(Category(name=name, slug=slugify(name), icon=icon, is_active=True))
 
-    if Product.query.count() == 0:
-        c_ring = Category.query.filter_by(slug="aneis").first()
-        c_neck = Category.query.filter_by(slug="colares").first()
-        c_ear = Category.query.filter_by(slug="brincos").first()
+    if counts["products"] == 0:
+        by_slug = {c.slug: c for c in Category.query.filter(Category.slug.in_(["aneis", "colares", "brincos"]))}
+        c_ring = by_slug.get("aneis")
+        c_neck = by_slug.get("colares")
+        c_ear = by_slug.get("brincos")
 
         demo = [
             ("Anel Ouro 18k Solitário", "Clássico atemporal em ouro 18k com brilho impecável.", "799.90", 10, "", c_ring.id if c_ring else None),
@@ -399,7 +896,7 @@ def seed_if_needed(app: Flask):
                 image_filename=""
             ))
 
-    if Banner.query.count() == 0:
+    if counts["banners"] == 0:
         db.session.add(Banner(
             title="Clássicos em Ouro 18k",
             subtitle="Luxo discreto. Linhas limpas. Brilho eterno.",
@@ -422,18 +919,101 @@ def create_app():
     os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
     os.makedirs(os.path.join(app.root_path, "instance"), exist_ok=True)
 
+    # templates compilados ficam em disco: workers novos não recompilam (só em dev recarregam)
+    if app.config.get("JINJA_BYTECODE_CACHE"):
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(
+            directory=_private_dir(app.config.get("JINJA_CACHE_DIR")), pattern="__jinja2_%s.cache"
+        )
+
     db.init_app(app)
     login_manager.init_app(app)
+    cache.init_app(app)
+    compress.init_app(app)
+    if Image is not None:
+        app.extensions["upload_executor"] = _native_executor(app.config.get("UPLOAD_WORKERS", 2))
+    app.jinja_env.globals.update(upload_srcset=upload_srcset, upload_variant=upload_variant)
 
     stripe.api_key = app.config.get("STRIPE_SECRET_KEY", "")
+    # padrão do SDK é 80s; não deixa o worker preso tanto tempo
+    stripe.default_http_client = stripe.RequestsClient(timeout=app.config["PAYMENT_READ_TIMEOUT"])
+
+    # Redis (opcional): cache de configurações compartilhado entre workers
+    # e sessão no servidor (o cookie carrega só o id; o carrinho fica no Redis)
+    if app.config.get("REDIS_URL"):
+        app.extensions["redis"] = redis.Redis.from_url(app.config["REDIS_URL"], decode_responses=True)
+        app.config["SESSION_TYPE"] = "redis"
+        app.config["SESSION_REDIS"] = redis.Redis.from_url(app.config["REDIS_URL"])  # binário (msgpack)
+        Session(app)
 
     with app.app_context():
-        db.create_all()
-        seed_if_needed(app)
+        if db.engine.dialect.name == "sqlite":
+            enable_sqlite_pragmas(db.engine, app.config.get("SQLITE_PRAGMAS", {}))
+        if app.config.get("DB_AUTO_MIGRATE"):
+            init_db(app)
+
+    if app.config.get("SQLALCHEMY_RAISELOAD"):
+        enable_raiseload()
+
+    @app.cli.command("init-db")
+    def init_db_command():
+        """Cria/atualiza as tabelas e os dados iniciais."""
+        init_db(app)
+        click.echo("Banco pronto.")
+
+    @app.cli.command("images-backfill")
+    def images_backfill_command():
+        """Gera as versões WebP que faltam para as imagens já enviadas."""
+        if Image is None:
+            raise click.ClickException("Pillow não está instalado.")
+        done, total = backfill_derivatives()
+        click.echo(f"{done} de {total} imagens processadas.")
 
     register_routes(app)
     return app
 
+def _private_dir(path: str | None) -> str | None:
+    # o cache guarda bytecode que o processo executa: a pasta tem de ser só nossa.
+    # None = padrão do Jinja (que faz a mesma checagem)
+    if not path:
+        return None
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    st = os.stat(path)
+    if st.st_uid != os.getuid() or st.st_mode & 0o077:
+        log.warning("JINJA_CACHE_DIR %s não é privado deste usuário; usando o padrão do Jinja", path)
+        return None
+    return path
+
+def _native_executor(max_workers: int):
+    # resize é CPU (Pillow). Com o worker gevent, threading está monkey-patched e o
+    # ThreadPoolExecutor comum viraria greenlets rodando no hub, travando todas as
+    # conexões do worker; o executor do gevent usa threads nativas.
+    try:
+        from gevent import monkey
+    except ImportError:
+        monkey = None
+    if monkey is not None and monkey.is_module_patched("threading"):
+        from gevent.threadpool import ThreadPoolExecutor as GeventNativeExecutor
+        return GeventNativeExecutor(max_workers=max_workers)
+    return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="upload")
+
+def enable_sqlite_pragmas(engine, pragmas: dict):
+    # roda antes da primeira conexão do pool; journal_mode=WAL persiste no arquivo
+    @event.listens_for(engine, "connect")
+    def _set_pragmas(dbapi_conn, _record):
+        cur = dbapi_conn.cursor()
+        try:
+            for name, value in pragmas.items():
+                cur.execute(f"PRAGMA {name}={value}")
+        finally:
+            cur.close()
+
+def enable_raiseload():
+    # dev/test: todo lazy load que precisaria de SQL levanta erro (pega N+1 cedo)
+    @event.listens_for(db.session, "do_orm_execute")
+    def _raiseload_all(state):
+        if state.is_select and not state.is_column_load and not state.is_relationship_load:
+            state.statement = state.statement.options(raiseload("*", sql_only=True))
+
 
 # -------------------------
 # Routes
@@ -448,10 +1028,7 @@ def register_routes(app: Flask):
         accent = get_setting("accent_color", "#B08D57")
         primary = get_setting("primary_color", "#111111")
 
-        cart = cart_get()
-        subtotal = cart_subtotal(cart)
-        ship = shipping_calc(subtotal)
-        total = subtotal + ship
+        cart = _cart_ctx()
 
         return dict(
             STORE_NAME=app.config.get("STORE_NAME", "NEXOR"),
@@ -459,22 +1036,53 @@ def register_routes(app: Flask):
             TOPBAR_NOTE=topbar_note,
             ACCENT_COLOR=accent,
             PRIMARY_COLOR=primary,
-            CART_COUNT=cart_count(cart),
-            CART_SUBTOTAL=format_brl(subtotal),
-            CART_TOTAL=format_brl(total),
+            CART_COUNT=cart["count"],
+            CART_SUBTOTAL=cart["subtotal_brl"],
+            CART_TOTAL=cart["total_brl"],
+            UPLOADS_URL=url_for("uploads", filename=""),
         )
 
+    @app.url_defaults
+    def static_version(endpoint, values):
+        # /static tem max-age longo; ?v=<mtime> muda a URL quando o arquivo muda
+        if endpoint == "static" and "filename" in values:
+            values.setdefault("v", _static_mtime(app.static_folder, values["filename"]))
+
     # ---------- uploads ----------
     @app.route("/uploads/<path:filename>")
     def uploads(filename):
-        return send_from_directory(app.config["UPLOAD_FOLDER"], filename)
+        accel = app.config.get("UPLOADS_ACCEL_PREFIX", "")
+        if accel:
+            # nginx entrega o arquivo (sendfile); o worker só responde o header
+            target = safe_join(accel, filename)
+            if target is None:
+                abort(404)
+            resp = app.response_class()
+            resp.headers["X-Accel-Redirect"] = target
+        else:
+            # nomes novos levam hash do conteúdo, então o arquivo nunca muda sob a mesma URL
+            resp = send_from_directory(
+                app.config["UPLOAD_FOLDER"], filename,
+                conditional=True, max_age=app.config.get("UPLOADS_MAX_AGE", 31536000)
+            )
+        resp.cache_control.max_age = app.config.get("UPLOADS_MAX_AGE", 31536000)
+        resp.cache_control.public = True
+        resp.cache_control.immutable = True
+        return resp
 
     # ---------- public ----------
+    def _listing_query():
+        # vitrines só usam estas colunas (description fica de fora; só a página do produto a carrega)
+        return db.session.query(
+            Product.id, Product.name, Product.slug, Product.price,
+            Product.image_filename, Product.stock, Product.category_id,
+        ).filter(Product.is_active.is_(True))
+
     @app.route("/")
     def index():
         banner = Banner.query.filter_by(is_active=True).order_by(Banner.created_at.desc()).first()
         categories = Category.query.filter_by(is_active=True).order_by(Category.created_at.asc()).all()
-        products = Product.query.filter_by(is_active=True).order_by(Product.created_at.desc()).limit(12).all()
+        products = _listing_query().order_by(Product.created_at.desc()).limit(12).all()
         return render_template("index.html", banner=banner, categories=categories, products=products)
 
     @app.route("/produtos")
@@ -482,13 +1090,14 @@ def register_routes(app: Flask):
         cat = (request.args.get("cat") or "").strip()
         q = (request.args.get("q") or "").strip()
         sort = (request.args.get("sort") or "new").strip()
+        page = request.args.get("page", 1, type=int)
 
-        query = Product.query.filter_by(is_active=True)
+        query = _listing_query()
 
         if cat:
             c = Category.query.filter_by(slug=cat).first()
             if c:
-                query = query.filter_by(category_id=c.id)
+                query = query.filter(Product.category_id == c.id)
 
         if q:
             like = f"%{q}%"
@@ -501,21 +1110,24 @@ def register_routes(app: Flask):
         else:
             query = query.order_by(Product.created_at.desc())
 
-        products = query.all()
+        pagination = query.paginate(page=page, per_page=app.config.get("PRODUCTS_PER_PAGE", 60), error_out=False)
         categories = Category.query.filter_by(is_active=True).order_by(Category.created_at.asc()).all()
-        return render_template("produtos.html", products=products, categories=categories, cat=cat, q=q, sort=sort)
+        return render_template(
+            "produtos.html",
+            products=pagination.items, pagination=pagination,
+            categories=categories, cat=cat, q=q, sort=sort
+        )
 
     @app.route("/p/<slug>")
     def produto(slug):
-        p = Product.query.filter_by(slug=slug, is_active=True).first_or_404()
+        p = Product.query.options(undefer(Product.description)).filter_by(slug=slug, is_active=True).first_or_404()
         cat = Category.query.filter_by(id=p.category_id).first() if p.category_id else None
-        sizes = [s.strip() for s in (p.sizes or "").split(",") if s.strip()]
-        return render_template("produto.html", p=p, cat=cat, sizes=sizes)
+        return render_template("produto.html", p=p, cat=cat, sizes=p.size_list)
 
     # ---------- cart API ----------
     @app.get("/api/cart")
     def api_cart():
-        return jsonify(cart_payload(app))
+        return jsonify(_cart_ctx())
 
     @app.post("/api/cart/add")
     def api_cart_add():
@@ -532,9 +1144,9 @@ def register_routes(app: Flask):
         if p.stock <= 0:
             return jsonify({"ok": False, "error": "Sem estoque."}), 400
 
-        sizes = [s.strip().upper() for s in (p.sizes or "").split(",") if s.strip()]
+        sizes = p.size_list
         if sizes and (not size or size not in sizes):
-            return jsonify({"ok": False, "need_size": True, "sizes": sizes}), 400
+            return jsonify({"ok": False, "need_size": True, "sizes": list(sizes)}), 400
 
         cart = cart_get()
         k = cart_key(product_id, size)
@@ -544,7 +1156,7 @@ def register_routes(app: Flask):
         cart[k] = new_qty
         cart_save(cart)
 
-        return jsonify({"ok": True, "message": "Adicionado ao carrinho!", "cart": cart_payload(app)})
+        return jsonify({"ok": True, "message": "Adicionado ao carrinho!", "cart": _cart_ctx()})
 
     @app.post("/api/cart/update")
     def api_cart_update():
@@ -558,11 +1170,12 @@ def register_routes(app: Flask):
             return jsonify({"ok": False, "error": "Item não encontrado."}), 404
 
         pid, _size = cart_split_key(key)
-        p = db.session.get(Product, pid)
-        if not p or not p.is_active:
+        # mesmo mapa (memoizado no g) que _cart_ctx usa logo abaixo: um SELECT só
+        p = cart_products_map(cart).get(pid)
+        if not p:
             cart.pop(key, None)
             cart_save(cart)
-            return jsonify({"ok": True, "cart": cart_payload(app)})
+            return jsonify({"ok": True, "cart": _cart_ctx()})
 
         if qty == 0:
             cart.pop(key, None)
@@ -570,7 +1183,7 @@ def register_routes(app: Flask):
             cart[key] = min(qty, p.stock)
 
         cart_save(cart)
-        return jsonify({"ok": True, "cart": cart_payload(app)})
+        return jsonify({"ok": True, "cart": _cart_ctx()})
 
     @app.post("/api/cart/remove")
     def api_cart_remove():
@@ -579,12 +1192,12 @@ def register_routes(app: Flask):
         cart = cart_get()
         cart.pop(key, None)
         cart_save(cart)
-        return jsonify({"ok": True, "cart": cart_payload(app)})
+        return jsonify({"ok": True, "cart": _cart_ctx()})
 
     @app.post("/api/cart/clear")
     def api_cart_clear():
         cart_save({})
-        return jsonify({"ok": True, "cart": cart_payload(app)})
+        return jsonify({"ok": True, "cart": _cart_ctx()})
 
     # ---------- checkout (3 etapas visual) ----------
     @app.route("/checkout", methods=["GET", "POST"])
@@ -595,7 +1208,7 @@ def register_routes(app: Flask):
             return redirect(url_for("produtos"))
 
         form = CheckoutForm()
-        payload = cart_payload(app)
+        payload = _cart_ctx()
 
         if form.validate_on_submit():
             # cria pedido
@@ -613,6 +1226,7 @@ def register_routes(app: Flask):
                 notes=(form.notes.data or "").strip(),
                 subtotal=subtotal,
                 shipping=ship,
+                shipping_cents=to_cents(ship),
                 total=total,
                 payment_provider="",
                 payment_ref="",
@@ -621,6 +1235,8 @@ def register_routes(app: Flask):
             db.session.flush()
 
             pmap = cart_products_map(cart)
+            order_items = []
+            stock_out = {}  # pid -> qtd (mesmo produto pode vir em vários tamanhos)
             for k, qty in cart.items():
                 pid, size = cart_split_key(k)
                 p = pmap.get(pid)
@@ -630,30 +1246,56 @@ def register_routes(app: Flask):
                 unit = money(p.price)
                 line = unit * qty_i
 
-                db.session.add(OrderItem(
-                    order_id=order.id,
-                    product_id=p.id,
-                    product_name=p.name,
-                    size=size,
-                    unit_price=unit,
-                    quantity=qty_i,
-                    line_total=line,
-                ))
-                # baixa estoque
-                p.stock = max(0, p.stock - qty_i)
+                order_items.append({
+                    "order_id": order.id,
+                    "product_id": p.id,
+                    "product_name": p.name,
+                    "size": size,
+                    "unit_price": unit,
+                    "unit_price_cents": to_cents(unit),
+                    "quantity": qty_i,
+                    "line_total": line,
+                })
+                stock_out[p.id] = stock_out.get(p.id, 0) + qty_i
+
+            # baixa estoque atômica: só decrementa se ainda houver quantidade
+            # (seguro com checkouts concorrentes, sem ler o estoque antes)
+            t = Product.__table__
+            for pid, q_i in stock_out.items():
+                res = db.session.execute(
+                    update(t)
+                    .where(t.c.id == pid, t.c.stock >= q_i)
+                    .values(stock=t.c.stock - q_i)
+                )
+                if res.rowcount == 0:
+                    db.session.rollback()
+                    flash(f"Sem estoque suficiente para {pmap[pid].name}.", "warning")
+                    return redirect(url_for("checkout"))
+
+            # itens num único executemany
+            if order_items:
+                db.session.execute(OrderItem.__table__.insert(), order_items)
 
             db.session.commit()
+            dashboard_stats_clear()
             cart_save({})
 
             return redirect(url_for("pagamento", order_id=order.id))
 
         return render_template("checkout.html", form=form, payload=payload)
 
-    @app.route("/pagamento/<int:order_id>")
-    def pagamento(order_id):
-        order = db.session.get(Order, order_id)
+    def _load_order(order_id: int):
+        # itens carregados num único IN (os templates e os payloads de pagamento iteram order.items)
+        order = db.session.execute(
+            select(Order).options(selectinload(Order.items)).where(Order.id == order_id)
+        ).scalar_one_or_none()
         if not order:
             abort(404)
+        return order
+
+    @app.route("/pagamento/<int:order_id>")
+    def pagamento(order_id):
+        order = _load_order(order_id)
 
         stripe_enabled = bool(app.config.get("STRIPE_SECRET_KEY"))
         mp_enabled = bool(app.config.get("MP_ACCESS_TOKEN"))
@@ -662,9 +1304,7 @@ def register_routes(app: Flask):
     # ---------- Stripe ----------
     @app.post("/pay/stripe/<int:order_id>")
     def pay_stripe(order_id):
-        order = db.session.get(Order, order_id)
-        if not order:
-            abort(404)
+        order = _load_order(order_id)
         if not app.config.get("STRIPE_SECRET_KEY"):
             flash("Stripe não configurado. Adicione STRIPE_SECRET_KEY no servidor.", "danger")
             return redirect(url_for("pagamento", order_id=order_id))
@@ -677,29 +1317,47 @@ def register_routes(app: Flask):
                 "price_data": {
                     "currency": "brl",
                     "product_data": {"name": name},
-                    "unit_amount": int(money(it.unit_price) * 100),
+                    "unit_amount": it.unit_price_cents,
                 },
                 "quantity": int(it.quantity),
             })
 
         # adicionar frete como item
-        if money(order.shipping) > 0:
+        if order.shipping_cents > 0:
             items.append({
                 "price_data": {
                     "currency": "brl",
                     "product_data": {"name": "Frete"},
-                    "unit_amount": int(money(order.shipping) * 100),
+                    "unit_amount": order.shipping_cents,
                 },
                 "quantity": 1,
             })
 
-        session_stripe = stripe.checkout.Session.create(
+        # sessão anterior ainda aberta: manda o cliente de volta para ela
+        if order.payment_provider == "stripe" and order.payment_ref:
+            try:
+                previous = stripe.checkout.Session.retrieve(order.payment_ref)
+            except stripe.error.StripeError:
+                previous = None
+            if previous is not None and previous.status == "open" and previous.url:
+                return redirect(previous.url, code=303)
+
+        params = dict(
             mode="payment",
             line_items=items,
             success_url=url_for("pay_success", order_id=order.id, _external=True),
             cancel_url=url_for("pagamento", order_id=order.id, _external=True),
             customer_email=order.customer_email or None,
+            client_reference_id=str(order.id),
         )
+        try:
+            session_stripe = stripe.checkout.Session.create(
+                **params, idempotency_key=stripe_idempotency_key(order.id, params)
+            )
+        except stripe.error.StripeError as e:
+            log.warning("Stripe Checkout falhou para o pedido %s: %s", order.id, e)
+            flash(e.user_message or "Erro ao criar pagamento no Stripe. Tente novamente em instantes.", "danger")
+            return redirect(url_for("pagamento", order_id=order_id))
 
         order.payment_provider = "stripe"
         order.payment_ref = session_stripe.id
@@ -708,25 +1366,70 @@ def register_routes(app: Flask):
 
         return redirect(session_stripe.url, code=303)
 
+    def _stripe_session_paid(session_id: str) -> bool:
+        try:
+            return stripe.checkout.Session.retrieve(session_id).payment_status == "paid"
+        except stripe.error.StripeError:
+            return False
+
     @app.route("/pay/success/<int:order_id>")
     def pay_success(order_id):
-        order = db.session.get(Order, order_id)
-        if not order:
-            abort(404)
+        order = _load_order(order_id)
 
         # Em produção, o correto é confirmar via Webhook do Stripe.
-        order.status = "Pago"
-        db.session.commit()
+        # refresh/segunda abertura da página não reescreve o pedido
+        if order.status in PAYABLE_STATUSES:
+            if order.payment_provider == "stripe" and order.payment_ref and not _stripe_session_paid(order.payment_ref):
+                # boleto etc.: o Stripe redireciona antes de o dinheiro chegar; o webhook confirma depois
+                flash("Pagamento em processamento. Avisaremos quando for confirmado.", "info")
+                return redirect(url_for("pedido_view", order_id=order_id))
+            order.status = "Pago"
+            db.session.commit()
 
         flash("Pagamento confirmado! Pedido registrado.", "success")
         return redirect(url_for("pedido_view", order_id=order_id))
 
+    @app.post("/webhooks/stripe")
+    def stripe_webhook():
+        secret = app.config.get("STRIPE_WEBHOOK_SECRET", "")
+        if not secret:
+            abort(404)
+        try:
+            event = stripe.Webhook.construct_event(
+                request.get_data(), request.headers.get("Stripe-Signature", ""), secret
+            )
+        except (ValueError, stripe.error.SignatureVerificationError):
+            abort(400)
+
+        if event["type"] not in STRIPE_SESSION_EVENTS:
+            return jsonify({"ok": True})
+
+        obj = event["data"]["object"]
+        order = Order.query.filter_by(payment_provider="stripe", payment_ref=obj["id"]).first()
+        if not order:
+            return jsonify({"ok": True})
+
+        # Stripe reenvia eventos; ignora repetidos ou mais antigos que o último aplicado
+        if order.stripe_event_id == event["id"] or event["created"] < (order.stripe_event_created or 0):
+            return jsonify({"ok": True, "duplicate": True})
+        if order.status not in PAYABLE_STATUSES:
+            # já pago/em andamento/cancelado: evento atrasado não muda nada
+            return jsonify({"ok": True})
+        # boleto: completed chega com payment_status "unpaid"; o dinheiro vem (ou não)
+        # depois em async_payment_succeeded/failed. Só "paid" marca o pedido.
+        if event["type"] == "checkout.session.async_payment_failed" or obj.get("payment_status") != "paid":
+            return jsonify({"ok": True, "paid": False})
+
+        order.status = "Pago"
+        order.stripe_event_id = event["id"]
+        order.stripe_event_created = event["created"]
+        db.session.commit()
+        return jsonify({"ok": True})
+
     # ---------- Mercado Pago (Preference) ----------
     @app.post("/pay/mp/<int:order_id>")
     def pay_mp(order_id):
-        order = db.session.get(Order, order_id)
-        if not order:
-            abort(404)
+        order = _load_order(order_id)
 
         token = app.config.get("MP_ACCESS_TOKEN", "")
         if not token:
@@ -740,15 +1443,15 @@ def register_routes(app: Flask):
                 "title": name,
                 "quantity": int(it.quantity),
                 "currency_id": "BRL",
-                "unit_price": float(money(it.unit_price)),
+                "unit_price": it.unit_price_cents / 100,
             })
 
-        if money(order.shipping) > 0:
+        if order.shipping_cents > 0:
             items.append({
                 "title": "Frete",
                 "quantity": 1,
                 "currency_id": "BRL",
-                "unit_price": float(money(order.shipping)),
+                "unit_price": order.shipping_cents / 100,
             })
 
         preference = {
@@ -764,13 +1467,16 @@ def register_routes(app: Flask):
             "auto_return": "approved",
         }
 
-        r = requests.post(
-            "https://api.mercadopago.com/checkout/preferences",
-            headers={"Authorization": f"Bearer {token}", "Content-Type": "application/json"},
-            json=preference,
-            timeout=25
-        )
-        if r.status_code >= 300:
+        try:
+            r = MP_SESSION.post(
+                "https://api.mercadopago.com/checkout/preferences",
+                headers={"Authorization": f"Bearer {token}"},
+                json=preference,
+                timeout=(app.config["PAYMENT_CONNECT_TIMEOUT"], app.config["PAYMENT_READ_TIMEOUT"])
+            )
+        except requests.RequestException:
+            r = None
+        if r is None or r.status_code >= 300:
             flash("Erro ao criar pagamento no Mercado Pago.", "danger")
             return redirect(url_for("pagamento", order_id=order_id))
 
@@ -786,9 +1492,7 @@ def register_routes(app: Flask):
     # ---------- Pedido público ----------
     @app.route("/pedido/<int:order_id>")
     def pedido_view(order_id):
-        order = db.session.get(Order, order_id)
-        if not order:
-            abort(404)
+        order = _load_order(order_id)
         return render_template("admin_pedido.html", order=order, public_view=True)
 
     # ---------- auth ----------
@@ -812,16 +1516,20 @@ def register_routes(app: Flask):
         return redirect(url_for("index"))
 
     # ---------- admin ----------
+    def _admin_paginate(stmt):
+        # listas do admin paginadas: memória e tempo de render constantes com o crescimento das tabelas
+        # só leitura: sem autoflush antes do COUNT e do SELECT da página
+        page = request.args.get("page", 1, type=int)
+        per_page = max(1, min(100, request.args.get("per_page", app.config.get("ADMIN_PER_PAGE", 25), type=int)))
+        with db.session.no_autoflush:
+            return db.paginate(stmt, page=page, per_page=per_page, error_out=False)
+
     @app.route("/admin")
     @login_required
     def admin_dashboard():
         require_admin()
-        stats = {
-            "produtos": Product.query.count(),
-            "categorias": Category.query.count(),
-            "pedidos": Order.query.count(),
-            "novos": Order.query.filter_by(status="Novo").count(),
-        }
+        with db.session.no_autoflush:
+            stats = _compute_dashboard_stats()
         return render_template("admin_dashboard.html", stats=stats)
 
     # ---- settings ----
@@ -832,34 +1540,36 @@ def register_routes(app: Flask):
         form = SettingsForm()
 
         if request.method == "GET":
-            form.store_name.data = get_setting("store_name", DEFAULT_SETTINGS["store_name"])
-            form.store_tagline.data = get_setting("store_tagline", DEFAULT_SETTINGS["store_tagline"])
-            form.whatsapp.data = get_setting("whatsapp", DEFAULT_SETTINGS["whatsapp"])
-            form.topbar_note.data = get_setting("topbar_note", DEFAULT_SETTINGS["topbar_note"])
-            form.shipping_free_over.data = money(get_setting("shipping_free_over", DEFAULT_SETTINGS["shipping_free_over"]))
-            form.shipping_flat.data = money(get_setting("shipping_flat", DEFAULT_SETTINGS["shipping_flat"]))
-            form.primary_color.data = get_setting("primary_color", DEFAULT_SETTINGS["primary_color"])
-            form.accent_color.data = get_setting("accent_color", DEFAULT_SETTINGS["accent_color"])
+            for k in _STRIP_FIELDS:
+                getattr(form, k).data = get_setting(k, DEFAULT_SETTINGS[k])
+            for k in _MONEY_FIELDS:
+                getattr(form, k).data = money(get_setting(k, DEFAULT_SETTINGS[k]))
 
         if form.validate_on_submit():
-            pairs = {
-                "store_name": form.store_name.data.strip(),
-                "store_tagline": (form.store_tagline.data or "").strip(),
-                "whatsapp": (form.whatsapp.data or "").strip(),
-                "topbar_note": (form.topbar_note.data or "").strip(),
-                "shipping_free_over": str(money(form.shipping_free_over.data)),
-                "shipping_flat": str(money(form.shipping_flat.data)),
-                "primary_color": (form.primary_color.data or "").strip() or "#111111",
-                "accent_color": (form.accent_color.data or "").strip() or "#B08D57",
-            }
-            for k, v in pairs.items():
-                s = Setting.query.filter_by(key=k).first()
-                if not s:
-                    s = Setting(key=k, value=str(v))
-                    db.session.add(s)
-                else:
-                    s.value = str(v)
+            pairs = {k: (getattr(form, k).data or "").strip() for k in _STRIP_FIELDS}
+            pairs.update({k: str(money(getattr(form, k).data)) for k in _MONEY_FIELDS})
+            pairs["primary_color"] = pairs["primary_color"] or DEFAULT_SETTINGS["primary_color"]
+            pairs["accent_color"] = pairs["accent_color"] or DEFAULT_SETTINGS["accent_color"]
+            rows = [{"key": k, "value": str(v)} for k, v in pairs.items()]
+            ins = upsert_insert(Setting)
+            if ins is not None:
+                # um único INSERT ... ON CONFLICT (key) DO UPDATE para todas as chaves
+                db.session.execute(ins.values(rows).on_conflict_do_update(
+                    index_elements=["key"], set_={"value": ins.excluded.value}
+                ))
+            else:
+                # sem ON CONFLICT: um SELECT das chaves e depois executemany (UPDATE por id + INSERT)
+                ids = dict(db.session.execute(
+                    select(Setting.key, Setting.id).where(Setting.key.in_(list(pairs)))
+                ).all())
+                updates = [{"id": ids[r["key"]], "value": r["value"]} for r in rows if r["key"] in ids]
+                new_rows = [r for r in rows if r["key"] not in ids]
+                if updates:
+                    db.session.execute(update(Setting), updates)
+                if new_rows:
+                    db.session.execute(Setting.__table__.insert(), new_rows)
             db.session.commit()
+            settings_cache_clear()
             flash("Configurações salvas.", "success")
             return redirect(url_for("admin_settings"))
 
@@ -870,8 +1580,8 @@ def register_routes(app: Flask):
     @login_required
     def admin_categorias():
         require_admin()
-        categories = Category.query.order_by(Category.created_at.desc()).all()
-        return render_template("admin_categorias.html", categories=categories)
+        pagination = _admin_paginate(select(Category).order_by(Category.created_at.desc()))
+        return render_template("admin_categorias.html", categories=pagination.items, pagination=pagination)
 
     @app.route("/admin/categorias/nova", methods=["GET", "POST"])
     @login_required
@@ -884,15 +1594,13 @@ def register_routes(app: Flask):
         if form.validate_on_submit():
             name = form.name.data.strip()
             base = slugify(name)
-            slug = base
-            i = 2
-            while Category.query.filter_by(slug=slug).first():
-                slug = f"{base}-{i}"
-                i += 1
-
-            c = Category(name=name, slug=slug, icon=(form.icon.data or "").strip(), is_active=bool(form.is_active.data))
-            db.session.add(c)
-            db.session.commit()
+
+            c = Category(name=name, icon=(form.icon.data or "").strip(), is_active=bool(form.is_active.data))
+            if not add_with_unique_slug(c, base):
+                flash("Não foi possível salvar a categoria. Tente novamente.", "danger")
+                return redirect(url_for("admin_categoria_nova"))
+            dashboard_stats_clear()
+            category_choices_clear()
             flash("Categoria criada.", "success")
             return redirect(url_for("admin_categorias"))
 
@@ -912,6 +1620,7 @@ def register_routes(app: Flask):
             c.icon = (form.icon.data or "").strip()
             c.is_active = bool(form.is_active.data)
             db.session.commit()
+            category_choices_clear()
             flash("Categoria atualizada.", "success")
             return redirect(url_for("admin_categorias"))
 
@@ -921,11 +1630,21 @@ def register_routes(app: Flask):
     @login_required
     def admin_categoria_delete(cat_id):
         require_admin()
-        c = db.session.get(Category, cat_id)
-        if not c:
+        # DELETE direto (sem carregar a categoria); produtos ficam sem categoria.
+        # O UPDATE explícito cobre o SQLite, que não aplica ON DELETE sem PRAGMA foreign_keys.
+        db.session.execute(
+            update(Product).where(Product.category_id == cat_id).values(category_id=None)
+            .execution_options(synchronize_session=False)
+        )
+        res = db.session.execute(
+            delete(Category).where(Category.id == cat_id).execution_options(synchronize_session=False)
+        )
+        if res.rowcount == 0:
+            db.session.rollback()
             abort(404)
-        db.session.delete(c)
         db.session.commit()
+        dashboard_stats_clear()
+        category_choices_clear()
         flash("Categoria removida.", "info")
         return redirect(url_for("admin_categorias"))
 
@@ -934,15 +1653,13 @@ def register_routes(app: Flask):
     @login_required
     def admin_produtos():
         require_admin()
-        products = Product.query.order_by(Product.created_at.desc()).all()
-        categories = Category.query.order_by(Category.name.asc()).all()
-        cmap = {c.id: c for c in categories}
-        return render_template("admin_produtos.html", products=products, cmap=cmap)
+        pagination = _admin_paginate(
+            select(Product).options(selectinload(Product.category)).order_by(Product.created_at.desc())
+        )
+        return render_template("admin_produtos.html", products=pagination.items, pagination=pagination)
 
     def _product_form_choices(form: ProductForm):
-        cats = Category.query.filter_by(is_active=True).order_by(Category.name.asc()).all()
-        choices = [(0, "— Sem categoria —")] + [(c.id, c.name) for c in cats]
-        form.category_id.choices = choices
+        form.category_id.choices = active_category_choices()
 
     @app.route("/admin/produtos/novo", methods=["GET", "POST"])
     @login_required
@@ -957,36 +1674,44 @@ def register_routes(app: Flask):
         if form.validate_on_submit():
             name = form.name.data.strip()
             base = slugify(name)
-            slug = base
-            i = 2
-            while Product.query.filter_by(slug=slug).first():
-                slug = f"{base}-{i}"
-                i += 1
 
-            image_filename = ""
             file = request.files.get("image")
-            if file and file.filename:
-                if not allowed_file(file.filename):
-                    flash("Imagem inválida. Use png/jpg/webp.", "danger")
-                    return redirect(url_for("admin_produto_novo"))
-                image_filename = secure_upload_name(slug, file.filename)
-                file.save(os.path.join(app.config["UPLOAD_FOLDER"], image_filename))
+            if file and file.filename and not allowed_file(file.filename):
+                flash("Imagem inválida. Use png/jpg/webp.", "danger")
+                return redirect(url_for("admin_produto_novo"))
 
             cat_id = int(form.category_id.data or 0) or None
 
             p = Product(
                 category_id=cat_id,
                 name=name,
-                slug=slug,
                 description=form.description.data or "",
                 price=money(form.price.data),
                 stock=int(form.stock.data),
                 sizes=(form.sizes.data or "").strip(),
                 is_active=bool(form.is_active.data),
-                image_filename=image_filename
+                image_filename=""
             )
-            db.session.add(p)
-            db.session.commit()
+            if not add_with_unique_slug(p, base):
+                flash("Não foi possível salvar o produto. Tente novamente.", "danger")
+                return redirect(url_for("admin_produto_novo"))
+            dashboard_stats_clear()
+
+            # imagem só depois do INSERT: o prefixo usa o slug definitivo e
+            # uma falha ao salvar o produto não deixa arquivo órfão
+            if file and file.filename:
+                image_filename = ""
+                try:
+                    image_filename = save_upload(file, p.slug)
+                    p.image_filename = image_filename
+                    db.session.commit()
+                except (OSError, SQLAlchemyError):
+                    db.session.rollback()
+                    if image_filename:
+                        remove_upload(image_filename)
+                    flash("Produto criado, mas a imagem não pôde ser salva. Envie novamente.", "danger")
+                    return redirect(url_for("admin_produto_editar", pid=p.id))
+
             flash("Produto criado.", "success")
             return redirect(url_for("admin_produtos"))
 
@@ -996,7 +1721,7 @@ def register_routes(app: Flask):
     @login_required
     def admin_produto_editar(pid):
         require_admin()
-        p = db.session.get(Product, pid)
+        p = db.session.get(Product, pid, options=[undefer(Product.description)])
         if not p:
             abort(404)
         form = ProductForm(obj=p)
@@ -1018,9 +1743,7 @@ def register_routes(app: Flask):
                 if not allowed_file(file.filename):
                     flash("Imagem inválida. Use png/jpg/webp.", "danger")
                     return redirect(url_for("admin_produto_editar", pid=pid))
-                image_filename = secure_upload_name(p.slug, file.filename)
-                file.save(os.path.join(app.config["UPLOAD_FOLDER"], image_filename))
-                p.image_filename = image_filename
+                p.image_filename = save_upload(file, p.slug)
 
             db.session.commit()
             flash("Produto atualizado.", "success")
@@ -1032,11 +1755,14 @@ def register_routes(app: Flask):
     @login_required
     def admin_produto_delete(pid):
         require_admin()
-        p = db.session.get(Product, pid)
-        if not p:
+        res = db.session.execute(
+            delete(Product).where(Product.id == pid).execution_options(synchronize_session=False)
+        )
+        if res.rowcount == 0:
+            db.session.rollback()
             abort(404)
-        db.session.delete(p)
         db.session.commit()
+        dashboard_stats_clear()
         flash("Produto removido.", "info")
         return redirect(url_for("admin_produtos"))
 
@@ -1045,8 +1771,8 @@ def register_routes(app: Flask):
     @login_required
     def admin_banners():
         require_admin()
-        banners = Banner.query.order_by(Banner.created_at.desc()).all()
-        return render_template("admin_banners.html", banners=banners)
+        pagination = _admin_paginate(select(Banner).order_by(Banner.created_at.desc()))
+        return render_template("admin_banners.html", banners=pagination.items, pagination=pagination)
 
     @app.route("/admin/banners/novo", methods=["GET", "POST"])
     @login_required
@@ -1065,8 +1791,7 @@ def register_routes(app: Flask):
                 if not allowed_file(file.filename):
                     flash("Imagem inválida. Use png/jpg/webp.", "danger")
                     return redirect(url_for("admin_banner_novo"))
-                image_filename = secure_upload_name("banner", file.filename)
-                file.save(os.path.join(app.config["UPLOAD_FOLDER"], image_filename))
+                image_filename = save_upload(file, "banner")
 
             b = Banner(
                 title=(form.title.data or "").strip(),
@@ -1104,9 +1829,7 @@ def register_routes(app: Flask):
                 if not allowed_file(file.filename):
                     flash("Imagem inválida. Use png/jpg/webp.", "danger")
                     return redirect(url_for("admin_banner_editar", bid=bid))
-                image_filename = secure_upload_name("banner", file.filename)
-                file.save(os.path.join(app.config["UPLOAD_FOLDER"], image_filename))
-                b.image_filename = image_filename
+                b.image_filename = save_upload(file, "banner")
 
             db.session.commit()
             flash("Banner atualizado.", "success")
@@ -1118,10 +1841,12 @@ def register_routes(app: Flask):
     @login_required
     def admin_banner_delete(bid):
         require_admin()
-        b = db.session.get(Banner, bid)
-        if not b:
+        res = db.session.execute(
+            delete(Banner).where(Banner.id == bid).execution_options(synchronize_session=False)
+        )
+        if res.rowcount == 0:
+            db.session.rollback()
             abort(404)
-        db.session.delete(b)
         db.session.commit()
         flash("Banner removido.", "info")
         return redirect(url_for("admin_banners"))
@@ -1132,26 +1857,32 @@ def register_routes(app: Flask):
     def admin_pedidos():
         require_admin()
         status = (request.args.get("status") or "").strip()
-        q = Order.query
+        # a lista só mostra o cabeçalho do pedido: sem address/notes e sem itens
+        # (raiseload: se o template passar a usar order.items, falha em vez de virar N+1)
+        stmt = select(Order).options(
+            load_only(
+                Order.id, Order.customer_email, Order.customer_name, Order.customer_phone,
+                Order.total, Order.status, Order.created_at,
+            ),
+            raiseload(Order.items),
+        )
         if status:
-            q = q.filter_by(status=status)
-        orders = q.order_by(Order.created_at.desc()).limit(300).all()
-        return render_template("admin_pedidos.html", orders=orders, status=status)
+            stmt = stmt.where(Order.status == status)
+        pagination = _admin_paginate(stmt.order_by(Order.created_at.desc()))
+        return render_template("admin_pedidos.html", orders=pagination.items, pagination=pagination, status=status)
 
     @app.route("/admin/pedidos/<int:oid>", methods=["GET", "POST"])
     @login_required
     def admin_pedido(oid):
         require_admin()
-        order = db.session.get(Order, oid)
-        if not order:
-            abort(404)
+        order = _load_order(oid)
 
         if request.method == "POST":
             new_status = (request.form.get("status") or "").strip()
-            allowed = {"Novo","Pagando","Pago","Separando","Enviado","Concluído","Cancelado"}
-            if new_status in allowed:
+            if new_status in ALLOWED_ORDER_STATUSES:
                 order.status = new_status
                 db.session.commit()
+                dashboard_stats_clear()
                 flash("Status atualizado.", "success")
             return redirect(url_for("admin_pedido", oid=oid))
 
@@ -1161,4 +1892,5 @@ def register_routes(app: Flask):
 app = create_app()
 
 if __name__ == "__main__":
-    app.run(debug=True)
\ No newline at end of file
+    # só para desenvolvimento; em produção: gunicorn -c gunicorn.conf.py app:app
+    app.run(debug=os.environ.get("FLASK_DEBUG") == "1")
\ No newline at end of file
@@ -5,6 +5,14 @@ BASE_DIR = Path(__file__).resolve().parent
 
 class Config:
     SECRET_KEY = os.environ.get("SECRET_KEY", "dev-secret-change-me")
+    DEBUG = False
+    # erros sobem para o gunicorn (log com traceback completo)
+    PROPAGATE_EXCEPTIONS = True
+    # bytecode dos templates compartilhado entre workers (JINJA_BYTECODE_CACHE=0 desliga).
+    # Sem JINJA_CACHE_DIR usa o padrão do Jinja (pasta 0700 do usuário, verificada).
+    # auto_reload segue o DEBUG (TEMPLATES_AUTO_RELOAD=None): desligado em produção.
+    JINJA_BYTECODE_CACHE = os.environ.get("JINJA_BYTECODE_CACHE", "1") == "1"
+    JINJA_CACHE_DIR = os.environ.get("JINJA_CACHE_DIR", "")
 
     # SQLite por padrão
     SQLALCHEMY_DATABASE_URI = os.environ.get(
@@ -16,6 +24,30 @@ class Config:
         SQLALCHEMY_DATABASE_URI = SQLALCHEMY_DATABASE_URI.replace("postgres://", "postgresql://", 1)
 
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # schema/seed no boot (dev). Em produção rode `flask --app app init-db` uma vez
+    # antes de subir os workers e use DB_AUTO_MIGRATE=0
+    DB_AUTO_MIGRATE = os.environ.get("DB_AUTO_MIGRATE", "1") == "1"
+    # cache de SQL compilado maior que o padrão (500): muitas variações de query ORM
+    SQLALCHEMY_ENGINE_OPTIONS = {"query_cache_size": 2000}
+    # Postgres: pool por processo (evita handshake TLS+auth a cada request)
+    if SQLALCHEMY_DATABASE_URI.startswith("postgresql"):
+        SQLALCHEMY_ENGINE_OPTIONS.update({
+            "pool_size": int(os.environ.get("DB_POOL_SIZE", "10")),
+            "max_overflow": int(os.environ.get("DB_MAX_OVERFLOW", "20")),
+            "pool_pre_ping": True,
+            "pool_recycle": 1800,
+        })
+    # SQLite: WAL + pragmas aplicados em cada conexão (ver enable_sqlite_pragmas)
+    SQLITE_PRAGMAS = {
+        "journal_mode": "WAL",       # leitores não bloqueiam o escritor
+        "synchronous": "NORMAL",     # seguro com WAL, bem menos fsync
+        "temp_store": "MEMORY",
+        "mmap_size": 268435456,      # 256MB
+        "cache_size": -65536,        # 64MB
+        "busy_timeout": 5000,        # ms esperando o lock de escrita antes de erro
+    }
+    # dev/test: SQLALCHEMY_RAISELOAD=1 faz qualquer lazy load com SQL levantar erro
+    SQLALCHEMY_RAISELOAD = os.environ.get("SQLALCHEMY_RAISELOAD") == "1"
 
     # ✅ Identidade da loja
     STORE_NAME = "NEXOR"
@@ -27,16 +59,50 @@ class Config:
     PRIMARY_COLOR = "#111111"
     ACCENT_COLOR = "#B08D57"
 
+    # ✅ Listagem de produtos
+    PRODUCTS_PER_PAGE = 60
+    ADMIN_PER_PAGE = 25
+
     # ✅ Frete (usado no carrinho/checkout)
     SHIPPING_FREE_OVER = "299.90"
     SHIPPING_FLAT = "9.90"
 
     # Uploads
     UPLOAD_FOLDER = os.environ.get("UPLOAD_FOLDER", str(BASE_DIR / "static" / "uploads"))
-    MAX_CONTENT_LENGTH = 8 * 1024 * 1024  # 8MB
+    MAX_CONTENT_LENGTH = 8 * 1024 * 1024  # 8MB (no nginx: client_max_body_size 8m;)
+    UPLOAD_WORKERS = int(os.environ.get("UPLOAD_WORKERS", "2"))  # threads de resize (WebP)
+    UPLOADS_MAX_AGE = 60 * 60 * 24 * 365  # 1 ano (nomes com hash do conteúdo)
+    # Com nginx na frente, ex. UPLOADS_ACCEL_PREFIX=/_uploads/ e:
+    #   location /_uploads/ { internal; alias /app/static/uploads/; }
+    # o Flask só devolve X-Accel-Redirect e o nginx envia o arquivo.
+    UPLOADS_ACCEL_PREFIX = os.environ.get("UPLOADS_ACCEL_PREFIX", "")
+
+    # /static com cache longo (URLs levam ?v=<mtime>)
+    SEND_FILE_MAX_AGE_DEFAULT = 60 * 60 * 24 * 30
+
+    # Compressão de respostas (Flask-Compress)
+    COMPRESS_MIMETYPES = ["text/html", "text/css", "application/json", "application/javascript"]
+    COMPRESS_LEVEL = 6
+    COMPRESS_MIN_SIZE = 500
 
     # Pagamentos (opcional)
     STRIPE_SECRET_KEY = os.environ.get("STRIPE_SECRET_KEY", "")
     STRIPE_PUBLIC_KEY = os.environ.get("STRIPE_PUBLIC_KEY", "")
+    STRIPE_WEBHOOK_SECRET = os.environ.get("STRIPE_WEBHOOK_SECRET", "")
 
     MP_ACCESS_TOKEN = os.environ.get("MP_ACCESS_TOKEN", "")
+
+    # Timeouts das chamadas aos provedores (segundos) - limitam quanto tempo um worker fica preso
+    PAYMENT_CONNECT_TIMEOUT = 5
+    PAYMENT_READ_TIMEOUT = 25
+
+    # Redis (opcional) - cache de configurações e sessão no servidor (Flask-Session)
+    REDIS_URL = os.environ.get("REDIS_URL", "")
+    SETTINGS_CACHE_TTL = 3600
+    # cópia das configurações em memória por processo (segundos)
+    SETTINGS_LOCAL_TTL = 60
+
+    # Cache (Flask-Caching): em memória por padrão; RedisCache quando REDIS_URL existe
+    CACHE_TYPE = "RedisCache" if REDIS_URL else "SimpleCache"
+    CACHE_REDIS_URL = REDIS_URL
+    CACHE_DEFAULT_TIMEOUT = 300
@@ -0,0 +1,34 @@
+import multiprocessing
+import os
+import subprocess
+import sys
+
+# gunicorn -c gunicorn.conf.py app:app
+bind = os.environ.get("GUNICORN_BIND", f"0.0.0.0:{os.environ.get('PORT', '8000')}")
+
+# gevent: esperas de rede (Stripe, Mercado Pago, Redis, uploads lentos) não prendem o worker.
+# O resize das imagens roda em threads nativas (ver _native_executor em app.py).
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gevent")
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", "1000"))
+
+timeout = 60
+graceful_timeout = 30
+keepalive = 5
+
+# recicla workers aos poucos (vazamentos de memória não se acumulam)
+max_requests = 2000
+max_requests_jitter = 200
+
+accesslog = "-"
+errorlog = "-"
+
+
+def on_starting(server):
+    # schema e seed uma vez só, no master, antes de existir qualquer worker;
+    # os workers herdam DB_AUTO_MIGRATE=0 e não repetem o DDL no boot
+    subprocess.run(
+        [sys.executable, "-m", "flask", "--app", "app", "init-db"],
+        check=True, env={**os.environ, "DB_AUTO_MIGRATE": "0"},
+    )
+    os.environ["DB_AUTO_MIGRATE"] = "0"